@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Common base for the bank backends.
+
+The `Transport` class owns the HTTP session shared by all backends (connection
+pooling, keep-alive, compression negotiation and content-type validation). The
+`Bank` class is the base for the backends themselves and holds the registry of
+supported transaction and statement formats.
+
+Downloads can use a `ValidatorCache` to avoid transferring documents which
+didn't change since the previous download.
+"""
+import os
+import hashlib
+import cPickle as pickle
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:24.0) Gecko/20100101 Firefox/24.0'
+
+# Default location of the validator cache
+CACHE_DIR = '~/.ibank/cache'
+
+# Download statistics kept by the transport
+STATS = ('downloads', 'not_modified', 'bytes_received', 'bytes_decoded', 'bytes_saved')
+
+
+class BankError(Exception):
+    pass
+
+
+class RequestFailedError(BankError):
+    def __init__(self, msg, response=None):
+        super(RequestFailedError, self).__init__(msg)
+        self._response = response
+
+
+class UnsupportedFormatError(BankError):
+    pass
+
+
+class Format(object):
+    ''' Description of a data format supported by a bank.
+
+    `content_types` is a list of content-type prefixes the server is expected
+    to send for this format (empty list means "don't check"), `binary` tells
+    whether the response body should be returned as raw bytes and `code` is
+    an optional bank-specific identifier of the format.
+    '''
+    def __init__(self, name, content_types=(), binary=False, code=None):
+        self.name = name
+        self.content_types = list(content_types)
+        self.binary = binary
+        self.code = code
+
+    def __repr__(self):
+        return 'Format({0!r})'.format(self.name)
+
+
+def write_if_changed(path, data):
+    ''' Write the data to the file unless the file already contains them.
+    Return True if the file was written.
+    '''
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as fh:
+                if fh.read() == data:
+                    return False
+    except (IOError, OSError):
+        pass
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    return True
+
+
+def formats(*items):
+    ''' Build a format registry (a dict mapping names to `Format` objects).
+    '''
+    return dict((f.name, f) for f in items)
+
+
+class ValidatorCache(object):
+    ''' Validators of previously downloaded documents stored in a directory.
+
+    For each cache key we remember the ETag and Last-Modified headers sent by
+    the server together with the body, so "304 Not Modified" responses can be
+    answered locally. Only the `max_entries` most recently used entries are
+    kept.
+    '''
+    def __init__(self, path=CACHE_DIR, max_entries=32):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+
+    def get(self, key):
+        try:
+            with open(self._file(key, 'meta'), 'rb') as fh:
+                return pickle.load(fh)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def has_body(self, key):
+        return os.path.exists(self._file(key, 'body'))
+
+    def get_body(self, key):
+        try:
+            with open(self._file(key, 'body'), 'rb') as fh:
+                return fh.read()
+        except IOError:
+            return None
+
+    def set(self, key, entry, body):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._write(self._file(key, 'body'), body)
+        self._write(self._file(key, 'meta'), pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+        self._prune()
+
+    def touch(self, key):
+        ''' Mark the entry as recently used.
+        '''
+        try:
+            os.utime(self._file(key, 'meta'), None)
+        except OSError:
+            pass
+
+    def delete(self, key):
+        for ext in ('meta', 'body'):
+            try:
+                os.remove(self._file(key, ext))
+            except OSError:
+                pass
+
+    def _prune(self):
+        entries = []
+        for filename in os.listdir(self.path):
+            if filename.endswith('.meta'):
+                mtime = os.path.getmtime(os.path.join(self.path, filename))
+                entries.append((mtime, filename[:-len('.meta')]))
+        entries.sort()
+        for mtime, key in entries[:-self.max_entries]:
+            self.delete(key)
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, '{0}.{1}'.format(key, ext))
+
+    def _write(self, path, data):
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmpfile, path)
+
+
+class Transport(object):
+    ''' HTTP transport shared by all bank backends.
+
+    `stats` counts the downloads and transferred bytes, `bytes_saved` includes
+    both the savings from compression and from "304 Not Modified" responses.
+    '''
+    def __init__(self, pool_connections=4, pool_maxsize=4, max_retries=0, cache=None,
+            error_class=RequestFailedError):
+        # Create a new requests session
+        self._session = requests.Session()
+        self._session.headers.update({
+                'user-agent': USER_AGENT,
+                'accept-encoding': 'gzip, deflate',
+                'connection': 'keep-alive',
+            })
+
+        # Mount adapters with our connection pool settings
+        adapter = HTTPAdapter(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                max_retries=max_retries,
+            )
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        # Validator cache, None disables conditional downloads
+        self.cache = cache
+
+        self.stats = dict.fromkeys(STATS, 0)
+
+        # Exception raised for failed requests, banks use their own subclass
+        self.error_class = error_class
+
+    def get(self, url, error_msg=None, **kwargs):
+        return self.request('GET', url, error_msg, **kwargs)
+
+    def post(self, url, error_msg=None, **kwargs):
+        return self.request('POST', url, error_msg, **kwargs)
+
+    def request(self, method, url, error_msg=None, **kwargs):
+        ''' Send the request and return the response.
+
+        If `error_msg` is given, raise `error_class` with that message unless
+        the server responds with HTTP 200.
+        '''
+        r = self._session.request(method, url, **kwargs)
+        if error_msg is not None and r.status_code != 200:
+            raise self.error_class(error_msg, r)
+        return r
+
+    def download(self, method, url, fmt, error_msg, cache_key=None, **kwargs):
+        ''' Download a document in the given format and return its body.
+
+        If there is a cache and a `cache_key` is given, the request is made
+        conditional on the ETag/Last-Modified of the previous download with
+        the same key. The key should identify the document regardless of
+        request details that change between runs. Don't pass it for requests
+        like "transactions since the last download", which must never be
+        answered from the cache.
+        '''
+        self.stats['downloads'] += 1
+
+        key = entry = None
+        if self.cache is not None and cache_key is not None:
+            key = hashlib.sha1(repr(cache_key)).hexdigest()
+            entry = self.cache.get(key)
+
+        # Ask for the document only if it changed
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None and self.cache.has_body(key):
+            if entry['etag'] is not None:
+                headers['if-none-match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                headers['if-modified-since'] = entry['last_modified']
+
+        r = self.request(method, url, headers=headers, **kwargs)
+
+        if r.status_code == 304 and entry is not None:
+            content = self.cache.get_body(key)
+            if content is not None:
+                self.cache.touch(key)
+                self.stats['not_modified'] += 1
+                self.stats['bytes_saved'] += len(content)
+                if not fmt.binary:
+                    content = self._decode(content, entry['encoding'])
+                return content
+
+        if r.status_code != 200:
+            raise self.error_class(error_msg, r)
+        self.check_content_type(r, fmt)
+
+        content = r.content
+        received = self._wire_size(r, content)
+        self.stats['bytes_received'] += received
+        self.stats['bytes_decoded'] += len(content)
+        self.stats['bytes_saved'] += max(len(content) - received, 0)
+
+        # Remember the validators, there is nothing to cache without them
+        if key is not None:
+            new_entry = {
+                    'etag': r.headers.get('etag'),
+                    'last_modified': r.headers.get('last-modified'),
+                    'encoding': self._encoding(r),
+                }
+            if new_entry['etag'] is not None or new_entry['last_modified'] is not None:
+                self.cache.set(key, new_entry, content)
+            elif entry is not None:
+                self.cache.delete(key)
+
+        return self.body(r, fmt)
+
+    def report(self, fh):
+        ''' Write the download statistics to the file.
+        '''
+        for name in STATS:
+            fh.write('{0}: {1}\n'.format(name, self.stats[name]))
+
+    def _wire_size(self, response, content):
+        ''' Return the number of (possibly compressed) bytes transferred.
+        '''
+        try:
+            return int(response.headers['content-length'])
+        except (KeyError, ValueError):
+            pass
+        try:
+            return response.raw.tell()
+        except (AttributeError, TypeError):
+            return len(content)
+
+    def check_content_type(self, response, fmt):
+        ''' Raise `error_class` if the response content-type doesn't match
+        the format.
+        '''
+        if not fmt.content_types:
+            return
+        ctype = response.headers.get('content-type', '')
+        for prefix in fmt.content_types:
+            if ctype.startswith(prefix):
+                return
+        raise self.error_class("Unexpected content-type: {0}".format(ctype), response)
+
+    def body(self, response, fmt):
+        ''' Return the response body as bytes for binary formats and as
+        unicode text otherwise.
+        '''
+        if fmt.binary:
+            return response.content
+        return self._decode(response.content, self._encoding(response))
+
+    def _encoding(self, response):
+        ''' Return the encoding of the response body, guessed from the body
+        if the server didn't send a charset (like `response.text` does).
+        '''
+        return response.encoding or response.apparent_encoding
+
+    def _decode(self, content, encoding):
+        try:
+            return content.decode(encoding or 'utf-8', 'replace')
+        except LookupError:
+            return content.decode('utf-8', 'replace')
+
+
+class Bank(object):
+    ''' Base class for bank backends.
+    '''
+    # Format registries, subclasses should override them (see `formats()`)
+    transaction_formats = {}
+    statement_formats = {}
+
+    # Exception raised for failed requests
+    request_failed_error = RequestFailedError
+
+    def __init__(self, transport=None):
+        if transport is None:
+            transport = Transport(error_class=self.request_failed_error)
+        self._transport = transport
+
+    @property
+    def transport(self):
+        return self._transport
+
+    def transaction_format(self, name):
+        return self._lookup_format(self.transaction_formats, name)
+
+    def statement_format(self, name):
+        return self._lookup_format(self.statement_formats, name)
+
+    def _lookup_format(self, registry, name):
+        try:
+            return registry[name]
+        except KeyError:
+            raise UnsupportedFormatError("Invalid format: {0}".format(name))
+
+
+#  vim: expandtab sw=4
@@ -15,6 +15,7 @@ Options:
   -f <format>, --format <format>   Data format [default: ofx]
   --account <account-id>           Account id if you have multiple accounts [default: 0]
   -o <file>, --output-file <file>  Output file
+  --stats                          Print download statistics to stderr
 
   <from_date>                      Download transactions since this date. Format:
                                    yyyy-mm-dd. If not specified download transactions
@@ -44,17 +45,17 @@ from datetime import date, timedelta
 from dateutil.parser import parse as dtparse
 from getpass import getpass
 
-import requests
+from ibank import base
+from ibank.base import Bank, BankError, Format, formats, \
+        ValidatorCache, write_if_changed
 
 
-class CitibankCzError(Exception):
+class CitibankCzError(BankError):
     pass
 
 
-class RequestFailedError(CitibankCzError):
-    def __init__(self, msg, response=None):
-        super(RequestFailedError, self).__init__(msg)
-        self._response = response
+class RequestFailedError(base.RequestFailedError, CitibankCzError):
+    pass
 
 
 class SessionExpiredError(CitibankCzError):
@@ -65,25 +66,28 @@ class LoginFailedError(CitibankCzError):
     pass
 
 
-class CitibankCz(object):
-    def __init__(self):
-        # Create a new requests session
-        self._session = requests.Session()
-        self._session.headers.update({'user-agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:24.0) Gecko/20100101 Firefox/24.0'})
+class CitibankCz(Bank):
+    request_failed_error = RequestFailedError
+
+    # Available transaction formats, the code is the value of the
+    # selectedDownloadFormat field in the download form
+    transaction_formats = formats(
+            Format('ofx', content_types=['application/OFX'], code=4),
+            Format('csv', content_types=['application/csv'], code=5),
+            Format('xls', content_types=['application/xls'], code=10),
+            Format('qif-quicken', content_types=['application/QIF'], code=6),
+            Format('qif-ms', content_types=['application/QIF'], code=7),
+        )
 
-        # List of available statement formats
-        self.transaction_formats = [
-                'ofx',
-                'csv',
-                'xls',
-                'qif-quicken',
-                'qif-ms',
-            ]
+    # Available statement formats
+    statement_formats = formats(
+            Format('pdf', content_types=['application/pdf'], binary=True),
+        )
 
     def login(self, read_username, read_password, read_sms_password):
         # GET the sign-in dialog and extract the sync token
         url_1 = 'https://production.citibank.cz/CZGCB/JSO/signon/DisplayUsernameSignon.do'
-        r = self._session.get(url_1)
+        r = self._transport.get(url_1)
         sync_token = self._extract_sync_token(r.text)
 
         # Send the username/password to the server
@@ -96,7 +100,7 @@ class CitibankCz(object):
                 'y': 0,
                 'smsLoginCheck': 'true'
             }
-        r = self._session.post(url_2, data=payload)
+        r = self._transport.post(url_2, data=payload)
 
         if re.search('Litujeme', r.text):
             raise LoginFailedError('Wrong username or password')
@@ -112,7 +116,7 @@ class CitibankCz(object):
                 'secureTxnCode': read_sms_password(),
             }
 
-        r = self._session.post(url_3, data=payload)
+        r = self._transport.post(url_3, data=payload)
 
         if not re.search(r'V.tejte', r.text):
             raise LoginFailedError('Wrong SMS password')
@@ -124,31 +128,21 @@ class CitibankCz(object):
         payload = {
                 'TTC': '264',
             }
-        r = self._session.post(url_1, data=payload)
-        if r.status_code != 200:
-            raise RequestFailedError("Initialize subapp request failed", r)
+        r = self._transport.post(url_1, "Initialize subapp request failed", data=payload)
 
         return (re.search('SignonForm', r.text) is None)
 
     def get_transactions(self, account_id, from_date, to_date, fmt):
         # Get the format id
-        supported_formats = {
-                'ofx': 4,
-                'csv': 5,
-                'xls': 10,
-                'qif-quicken': 6,
-                'qif-ms': 7,
-            }
-        fmt_id = supported_formats[fmt]
+        fmt = self.transaction_format(fmt)
+        fmt_id = fmt.code
 
         # Send request to initialize the app
         url_1 = 'https://production.citibank.cz/CZGCB/jba/daa/InitializeSubApp.do'
         payload = {
                 'TTC': '264',
             }
-        r = self._session.post(url_1, data=payload)
-        if r.status_code != 200:
-            raise RequestFailedError("Initialize subapp request failed", r)
+        r = self._transport.post(url_1, "Initialize subapp request failed", data=payload)
 
         if re.search('SignonForm', r.text):
             raise SessionExpiredError("Session expired")
@@ -184,49 +178,38 @@ class CitibankCz(object):
             payload['fromDate'] = from_date.strftime('%d/%m/%Y')
             payload['toDate'] = to_date.strftime('%d/%m/%Y')
 
-        r = self._session.post(url_2, data=payload)
-        if r.status_code != 200:
-            raise RequestFailedError("Setup request failed", r)
+        r = self._transport.post(url_2, "Setup request failed", data=payload)
 
         # Initialize download request
         url_3 = 'https://production.citibank.cz/CZGCB/jba/daa/downloadActivity.do'
         payload = {
                 'xyz': ''
             }
-        r = self._session.post(url_3, data=payload)
-        if r.status_code != 200:
-            raise RequestFailedError("Initialize download request failed", r)
+        r = self._transport.post(url_3, "Initialize download request failed", data=payload)
 
         # Download the file finally
         url_4 = 'https://production.citibank.cz/CZGCB/jba/daa/Opendownload.do'
         payload = {
                 'xyz': ''
             }
-        r = self._session.post(url_4, data=payload)
-        if r.status_code != 200:
-            raise RequestFailedError("Download request failed", r)
-
-        # Check the content-type
-        ctype = r.headers['content-type']
-        if fmt == 'ofx' and not ctype.startswith('application/OFX'):
-            raise RequestFailedError("Unexpected content-type: {0}".format(ctype), r)
-        if fmt == 'csv' and not ctype.startswith('application/csv'):
-            raise RequestFailedError("Unexpected content-type: {0}".format(ctype), r)
-        if fmt == 'xls' and not ctype.startswith('application/xls'):
-            raise RequestFailedError("Unexpected content-type: {0}".format(ctype), r)
-        if fmt in ('qif-quicken', 'qif-ms') and not ctype.startswith('application/QIF'):
-            raise RequestFailedError("Unexpected content-type: {0}".format(ctype), r)
-
-        return r.text.strip()
+        # The request parameters were sent in the previous steps, so they make
+        # up the cache key. The to_date moves with every run so it's left out,
+        # and transactions since the last download must not come from the
+        # cache at all.
+        cache_key = None
+        if from_date is not None:
+            cache_key = (url_4, account_id, from_date, fmt.name)
+        transactions = self._transport.download('POST', url_4, fmt,
+                "Download request failed", cache_key=cache_key, data=payload)
+
+        return transactions.strip()
 
     def get_statement(self, account_id, year, statement_id):
         ''' Download the specified PDF account statement.
         '''
         # Send request to initialize the app
         url_1 = 'https://production.citibank.cz/CZGCB/cba/estmtview/InitializeSubApp.do'
-        r = self._session.get(url_1)
-        if r.status_code != 200:
-            raise RequestFailedError("Initialize subapp request failed", r)
+        r = self._transport.get(url_1, "Initialize subapp request failed")
 
         # Select account
         url_2 = 'https://production.citibank.cz/CZGCB/cba/estmtview/FireListqMsg.do'
@@ -236,9 +219,7 @@ class CitibankCz(object):
                 'pdfDisplay': 'Inline',
                 'warnStatus': 'true',
             }
-        r = self._session.post(url_2, data=payload)
-        if r.status_code != 200:
-            raise RequestFailedError("Statement download failed", r)
+        r = self._transport.post(url_2, "Statement download failed", data=payload)
 
         # Select year
         url_3 = 'https://production.citibank.cz/CZGCB/cba/estmtview/BuildStatementDates.do'
@@ -249,9 +230,7 @@ class CitibankCz(object):
                 'pdfDisplay': 'Inline',
                 'warnStatus': 'true',
             }
-        r = self._session.post(url_3, data=payload)
-        if r.status_code != 200:
-            raise RequestFailedError("Build statement dates failed", r)
+        r = self._transport.post(url_3, "Build statement dates failed", data=payload)
 
         # Select statement
         url_4 = 'https://production.citibank.cz/CZGCB/cba/estmtview/FireVwstqMsg.do'
@@ -263,9 +242,7 @@ class CitibankCz(object):
                 'pdfDisplay': 'Attachment',
                 'warnStatus': 'false',
             }
-        r = self._session.post(url_4, data=payload)
-        if r.status_code != 200:
-            raise RequestFailedError("Build statement #2 failed", r)
+        r = self._transport.post(url_4, "Build statement #2 failed", data=payload)
 
         # Download statement
         url_5 = 'https://production.citibank.cz/CZGCB/cba/estmtview/DisplayStatementAction.do'
@@ -277,15 +254,9 @@ class CitibankCz(object):
                 'pdfDisplay': 'Attachment',
                 'warnStatus': 'false',
             }
-        r = self._session.post(url_5, data=payload)
-        if r.status_code != 200:
-            raise RequestFailedError("Statement download failed", r)
-
-        # Check content-type
-        if r.headers['content-type'] != 'application/pdf':
-            raise RequestFailedError("Unexpected content-type: {0}".format(r.headers['content-type']), r)
-
-        return r.content
+        cache_key = (url_5, account_id, year, statement_id)
+        return self._transport.download('POST', url_5, self.statement_format('pdf'),
+                "Statement download failed", cache_key=cache_key, data=payload)
 
 
     def _extract_sync_token(self, string):
@@ -319,6 +290,7 @@ def _parse_args():
                 'from_date': from_date,
                 'to_date': to_date,
                 'output_file': opts['--output-file'],
+                'stats': opts['--stats'],
             }
 
     elif opts['statement']:
@@ -328,6 +300,7 @@ def _parse_args():
                 'account_id': int(opts['--account']),
                 'statement_id': int(opts['<statement>']),
                 'output_file': opts['--output-file'],
+                'stats': opts['--stats'],
             }
 
 
@@ -361,11 +334,15 @@ def main():
             bank = pickle.load(open(statefile, 'r'))
         except IOError:
             bank = CitibankCz()
+        if not hasattr(bank, '_transport'):
+            # State saved by an older version, start over
+            bank = CitibankCz()
         if not bank.logged_in():
             bank.login(read_username, read_password, read_sms_password)
             if not os.path.isdir(cfgdir):
                 os.mkdir(cfgdir)
             pickle.dump(bank, open(statefile, 'w'))
+        bank.transport.cache = ValidatorCache(os.path.join(cfgdir, 'cache'))
 
         # Run the command
         if args['cmd'] == 'transactions':
@@ -373,10 +350,6 @@ def main():
             if args['account_id'] < 0:
                 raise ValueError("Invalid account_id: {0}".format(args['account_id']))
 
-            # Check format
-            if args['fmt'] not in bank.transaction_formats:
-                raise ValueError("Invalid format: {0}".format(args['fmt']))
-
             # If we have from_date, but no to_date, initialize to_date to at most
             # yesterday
             if args['from_date'] is not None and \
@@ -398,8 +371,8 @@ def main():
                             args['to_date'].isoformat(),
                             args['fmt'])
 
-            with open(output_file, 'w') as fh:
-                fh.write(transactions.encode('utf-8'))
+            # Don't rewrite the file if its contents didn't change
+            write_if_changed(output_file, transactions.encode('utf-8'))
 
             print output_file
 
@@ -414,11 +387,13 @@ def main():
                         args['year'],
                         args['statement_id'])
 
-            with open(output_file, 'w') as fh:
-                fh.write(statement_data)
+            write_if_changed(output_file, statement_data)
 
             print output_file
 
+        if args['stats']:
+            bank.transport.report(sys.stderr)
+
     except KeyboardInterrupt:
         pass
 
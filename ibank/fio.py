@@ -15,6 +15,7 @@ Options:
   --format <format>                Data format [default: ofx]
   --account <account-id>           Account id if you have multiple accounts [default: 0]
   -o <file>, --output-file <file>  Output file
+  --stats                          Print download statistics to stderr
 
   <token>                          Authorization token
   <from_date>                      Download transactions since this date. Format:
@@ -32,54 +33,47 @@ Transaction formats:
 Statement formats:
   xml, ofx, gpc, csv, html, json, sta, pdf
 """
-from docopt import docopt
-
 import sys
 from docopt import docopt
 from dateutil.parser import parse as dtparse
 from datetime import date, timedelta
 
-import requests
+from ibank import base
+from ibank.base import Bank, BankError, Format, formats, \
+        ValidatorCache, write_if_changed
 
 
-class FioError(Exception):
+class FioError(BankError):
     pass
 
 
-class RequestFailedError(FioError):
-    def __init__(self, msg, response=None):
-        super(RequestFailedError, self).__init__(msg)
-        self._response = response
-
-
-class Fio(object):
-    def __init__(self):
-        # Create a new requests session
-        self._session = requests.Session()
-        self._session.headers.update({'user-agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:24.0) Gecko/20100101 Firefox/24.0'})
-
-        # List of available transaction formats
-        self.transaction_formats = [
-                'xml',
-                'ofx',
-                'gpc',
-                'csv',
-                'html',
-                'json',
-                'sta',
-            ]
-
-        # List of available statement formats
-        self.statement_formats = [
-                'xml',
-                'ofx',
-                'gpc',
-                'csv',
-                'html',
-                'json',
-                'sta',
-                'pdf',
-            ]
+class RequestFailedError(base.RequestFailedError, FioError):
+    pass
+
+
+# Formats shared by transactions and statements
+_TEXT_FORMATS = (
+        Format('xml'),
+        Format('ofx'),
+        Format('gpc'),
+        Format('csv'),
+        Format('html'),
+        Format('json'),
+        Format('sta'),
+    )
+
+
+class Fio(Bank):
+    request_failed_error = RequestFailedError
+
+    # Available transaction formats
+    transaction_formats = formats(*_TEXT_FORMATS)
+
+    # Available statement formats
+    statement_formats = formats(
+            Format('pdf', content_types=['application/pdf'], binary=True),
+            *_TEXT_FORMATS
+        )
 
     def get_transactions(self, token, from_date, to_date, fmt):
         url = 'https://www.fio.cz/ib_api/rest/periods/{token}/{from_date}/{to_date}/transactions.{fmt}'
@@ -89,10 +83,10 @@ class Fio(object):
                 to_date=to_date.strftime('%Y-%m-%d'),
                 fmt=fmt,
             )
-        r = self._session.get(url)
-        if r.status_code != 200:
-            raise RequestFailedError("Download transactions failed", r)
-        return r.text
+        # The to_date moves with every run, so it's not part of the cache key
+        cache_key = ('transactions', token, from_date, fmt)
+        return self._download(url, self.transaction_format(fmt),
+                "Download transactions failed", cache_key)
 
     def get_last_transactions(self, token, fmt):
         url = 'https://www.fio.cz/ib_api/rest/last/{token}/transactions.{fmt}'
@@ -100,10 +94,8 @@ class Fio(object):
                 token=token,
                 fmt=fmt,
             )
-        r = self._session.get(url)
-        if r.status_code != 200:
-            raise RequestFailedError("Download transactions failed", r)
-        return r.text
+        return self._download(url, self.transaction_format(fmt),
+                "Download transactions failed")
 
     def get_statement(self, token, year, statement_id, fmt):
         url = 'https://www.fio.cz/ib_api/rest/by-id/{token}/{year}/{statement_id}/transactions.{fmt}'
@@ -113,13 +105,12 @@ class Fio(object):
                 statement_id=statement_id,
                 fmt=fmt,
             )
-        r = self._session.get(url)
-        if r.status_code != 200:
-            raise RequestFailedError("Download statement failed", r)
-        if r.headers['content-type'].startswith('application/pdf'):
-            return r.content
-        else:
-            return r.text
+        cache_key = ('statement', token, year, statement_id, fmt)
+        return self._download(url, self.statement_format(fmt),
+                "Download statement failed", cache_key)
+
+    def _download(self, url, fmt, error_msg, cache_key=None):
+        return self._transport.download('GET', url, fmt, error_msg, cache_key=cache_key)
 
 
 def _parse_args():
@@ -145,6 +136,7 @@ def _parse_args():
                 'from_date': from_date,
                 'to_date': to_date,
                 'output_file': opts['--output-file'],
+                'stats': opts['--stats'],
             }
 
     elif opts['statement']:
@@ -155,6 +147,7 @@ def _parse_args():
                 'statement_id': int(opts['<statement>']),
                 'fmt': opts['--format'],
                 'output_file': opts['--output-file'],
+                'stats': opts['--stats'],
             }
 
 
@@ -165,13 +158,10 @@ def main():
 
         # Create bank object
         bank = Fio()
+        bank.transport.cache = ValidatorCache()
 
         # Run the command
         if args['cmd'] == 'transactions':
-            # Check the format
-            if args['fmt'] not in bank.transaction_formats:
-                raise Exception("Invalid format: {0}".format(args['fmt']))
-
             # If we have from_date, but no to_date, initialize to_date to at most
             # yesterday
             if args['from_date'] is not None and \
@@ -196,8 +186,8 @@ def main():
                             args['to_date'].isoformat(),
                             args['fmt'])
 
-            with open(output_file, 'w') as fh:
-                fh.write(transactions.encode('utf-8'))
+            # Don't rewrite the file if its contents didn't change
+            write_if_changed(output_file, transactions.encode('utf-8'))
 
             print output_file
 
@@ -212,10 +202,14 @@ def main():
                         args['year'],
                         args['statement_id'],
                         args['fmt'])
-            with open(output_file, 'w') as fh:
-                fh.write(statement)
+            if isinstance(statement, unicode):
+                statement = statement.encode('utf-8')
+            write_if_changed(output_file, statement)
             print output_file
 
+        if args['stats']:
+            bank.transport.report(sys.stderr)
+
     except KeyboardInterrupt:
         pass
 
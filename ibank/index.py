@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+"""
+Build a search index over downloaded transactions and query it.
+
+Usage:
+  ibank-index add [options] <path>...
+  ibank-index update [options]
+  ibank-index search [options]
+  ibank-index (-h | --help)
+
+Commands:
+  add                              Index transaction files; directories are
+                                   scanned and remembered for `update`
+  update                           Re-index added files and directories, only
+                                   new and modified files are parsed
+  search                           Find transactions matching all given criteria
+
+Options:
+  -i <file>, --index-file <file>   Index file [default: ~/.ibank/index.sqlite]
+  --account <account>              Counterparty account number
+  --name <name>                    Words in the counterparty name
+  --vs <symbol>                    Variable symbol
+  --ks <symbol>                    Constant symbol
+  --ss <symbol>                    Specific symbol
+  --amount <amount>                Exact amount (absolute value)
+  --min-amount <amount>            Minimal amount (absolute value)
+  --max-amount <amount>            Maximal amount (absolute value)
+  --text <words>                   Words in the counterparty name or the memo
+
+Supported files:
+  json                             Fio Banka JSON transactions
+  ofx                              OFX (Fio Banka, Citibank CZ)
+"""
+import os
+import sys
+import re
+import json
+import hashlib
+import sqlite3
+from docopt import docopt
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from ibank.base import BankError
+
+
+# Indexed fields
+FIELDS = ('account', 'name', 'vs', 'ks', 'ss', 'text')
+
+
+class TransactionIndexError(BankError):
+    pass
+
+
+class UnsupportedFileError(TransactionIndexError):
+    pass
+
+
+def _transaction(**kwargs):
+    ''' Create a transaction record with all fields present.
+    '''
+    record = {
+            'id': None,
+            'date': None,
+            'amount': None,
+            'currency': None,
+            'account': None,
+            'name': None,
+            'vs': None,
+            'ks': None,
+            'ss': None,
+            'memo': None,
+        }
+    record.update(kwargs)
+    return record
+
+
+class _Keys(object):
+    ''' Assign keys to the transactions parsed from one file.
+
+    Transactions without a bank-assigned id get a key derived from their
+    contents; identical ones are numbered so they don't merge.
+    '''
+    def __init__(self, own_account):
+        self.own_account = own_account
+        self._seen = {}
+
+    def __call__(self, ident, t):
+        if ident is None:
+            data = repr([t[field] for field in ('date', 'amount', 'currency',
+                    'account', 'name', 'vs', 'ks', 'ss', 'memo')])
+            ident = u'~' + hashlib.sha1(data).hexdigest()[:16]
+            count = self._seen.get(ident, 0)
+            self._seen[ident] = count + 1
+            if count:
+                ident = u'{0}.{1}'.format(ident, count)
+        t['id'] = u'{0}:{1}'.format(self.own_account, ident)
+        return t
+
+
+def parse_fio_json(text):
+    ''' Parse transactions in the Fio Banka JSON format.
+    '''
+    statement = json.loads(text)['accountStatement']
+    keys = _Keys(statement['info'].get('accountId'))
+
+    transaction_list = statement.get('transactionList') or {}
+    for item in transaction_list.get('transaction') or []:
+        def column(n):
+            col = item.get('column{0}'.format(n))
+            if col is None:
+                return None
+            return col['value']
+
+        # Skip rows without an amount
+        if column(1) is None:
+            continue
+
+        # Counterparty account including the bank code
+        account = column(2)
+        if account is not None and column(3) is not None:
+            account = u'{0}/{1}'.format(account, column(3))
+
+        memo = u' '.join(unicode(v) for v in (column(16), column(7), column(25)) if v)
+
+        yield keys(column(22), _transaction(
+                date=column(0)[:10] if column(0) else None,
+                amount=Decimal(str(column(1))),
+                currency=column(14),
+                account=account,
+                name=column(10),
+                vs=column(5),
+                ks=column(4),
+                ss=column(6),
+                memo=memo or None,
+            ))
+
+
+def parse_ofx(text):
+    ''' Parse transactions in the OFX format (both SGML and XML flavours).
+    '''
+    def tag(block, name):
+        match = re.search(r'<{0}>([^<\r\n]*)'.format(name), block, re.I)
+        if match is None:
+            return None
+        return match.group(1).strip() or None
+
+    def ofx_date(value):
+        if value is None or len(value) < 8:
+            return None
+        return date(int(value[0:4]), int(value[4:6]), int(value[6:8])).isoformat()
+
+    keys = _Keys(tag(text, 'ACCTID'))
+    currency = tag(text, 'CURDEF')
+
+    for block in re.findall(r'<STMTTRN>(.*?)(?:</STMTTRN>|(?=<STMTTRN>)|</BANKTRANLIST>)', text, re.I | re.S):
+        # Skip transactions without an amount
+        amount = tag(block, 'TRNAMT')
+        if amount is None:
+            continue
+
+        account = None
+        match = re.search(r'<BANKACCTTO>(.*?)</BANKACCTTO>', block, re.I | re.S)
+        if match is not None:
+            account = tag(match.group(1), 'ACCTID')
+            bank_id = tag(match.group(1), 'BANKID')
+            if account is not None and bank_id is not None:
+                account = u'{0}/{1}'.format(account, bank_id)
+
+        yield keys(tag(block, 'FITID'), _transaction(
+                date=ofx_date(tag(block, 'DTPOSTED')),
+                amount=Decimal(amount.replace(',', '.')),
+                currency=tag(block, 'CURRENCY') or currency,
+                account=account,
+                name=tag(block, 'NAME') or tag(block, 'PAYEE'),
+                vs=tag(block, 'CHECKNUM'),
+                memo=tag(block, 'MEMO'),
+            ))
+
+
+# Parsers by file extension
+PARSERS = {
+        '.json': parse_fio_json,
+        '.ofx': parse_ofx,
+    }
+
+
+def parse_file(path):
+    ''' Parse the transactions stored in the file.
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in PARSERS:
+        raise UnsupportedFileError("Unsupported file: {0}".format(path))
+    with open(path, 'r') as fh:
+        text = fh.read().decode('utf-8', 'replace')
+    try:
+        return list(PARSERS[ext](text))
+    except (ValueError, KeyError, TypeError, AttributeError, InvalidOperation), e:
+        raise TransactionIndexError("Failed to parse {0}: {1!r}".format(path, e))
+
+
+def _words(text):
+    if not text:
+        return set()
+    return set(re.findall(r'\w+', text.lower(), re.U))
+
+
+def _normalize(value):
+    if value is None:
+        return None
+    value = re.sub(r'\s+', '', unicode(value)).lower()
+    # Account numbers and symbols may be zero-padded
+    return value.lstrip('0') or value
+
+
+# Database schema, transactions are linked to the files they were parsed from
+# and each indexed term is a row in the `terms` table
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS roots (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id TEXT PRIMARY KEY,
+    date TEXT,
+    amount TEXT,
+    magnitude REAL,
+    currency TEXT,
+    account TEXT,
+    name TEXT,
+    vs TEXT,
+    ks TEXT,
+    ss TEXT,
+    memo TEXT
+);
+CREATE INDEX IF NOT EXISTS transactions_magnitude ON transactions (magnitude);
+CREATE TABLE IF NOT EXISTS file_transactions (
+    path TEXT,
+    id TEXT,
+    PRIMARY KEY (path, id)
+);
+CREATE INDEX IF NOT EXISTS file_transactions_id ON file_transactions (id);
+CREATE TABLE IF NOT EXISTS terms (
+    field TEXT,
+    term TEXT,
+    id TEXT,
+    PRIMARY KEY (field, term, id)
+);
+CREATE INDEX IF NOT EXISTS terms_id ON terms (id);
+'''
+
+# Stored transaction fields
+COLUMNS = ('id', 'date', 'amount', 'currency', 'account', 'name', 'vs', 'ks', 'ss', 'memo')
+
+
+class TransactionIndex(object):
+    ''' Inverted indexes over parsed transactions stored in a SQLite database.
+
+    Each field in FIELDS maps the indexed terms to transaction ids, amounts
+    are looked up by an index on their absolute value. Queries only read the
+    matching rows, so they don't depend on the size of the index.
+
+    Files are re-parsed only if their size or modification time changes.
+    A transaction may be contained in several (overlapping) files, it is
+    removed when the last of them is removed.
+    '''
+    def __init__(self, path=':memory:'):
+        if path != ':memory:':
+            cfgdir = os.path.dirname(path)
+            if cfgdir and not os.path.isdir(cfgdir):
+                os.makedirs(cfgdir)
+        try:
+            self._db = sqlite3.connect(path)
+            self._db.executescript(_SCHEMA)
+        except sqlite3.DatabaseError, e:
+            raise TransactionIndexError("Cannot open index {0}: {1}".format(path, e))
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+
+    def add(self, path):
+        ''' Index the file or all supported files in the directory. Return
+        the number of re-indexed files.
+
+        Files in the directory which fail to parse are reported to stderr and
+        skipped, a file given explicitly raises TransactionIndexError.
+        '''
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            count = self._scan(path)
+        else:
+            count = self._add_file(path)
+        with self._db:
+            self._db.execute('INSERT OR IGNORE INTO roots (path) VALUES (?)', (path,))
+        return count
+
+    def update(self):
+        ''' Re-index new and modified files, drop the deleted ones. Return the
+        number of re-indexed files.
+        '''
+        for (path,) in self._db.execute('SELECT path FROM files').fetchall():
+            if not os.path.exists(path):
+                with self._db:
+                    self._remove_file(path)
+        count = 0
+        for (root,) in self._db.execute('SELECT path FROM roots').fetchall():
+            if os.path.exists(root):
+                count += self._scan(root)
+        return count
+
+    def _scan(self, path):
+        if os.path.isdir(path):
+            paths = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in PARSERS:
+                        paths.append(os.path.join(dirpath, filename))
+        else:
+            paths = [path]
+
+        count = 0
+        for path in paths:
+            try:
+                count += self._add_file(path)
+            except (TransactionIndexError, EnvironmentError), e:
+                sys.stderr.write('{0}, skipping\n'.format(e))
+        return count
+
+    def _add_file(self, path):
+        st = os.stat(path)
+        row = self._db.execute('SELECT size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None and tuple(row) == (st.st_size, st.st_mtime):
+            return 0
+
+        transactions = parse_file(path)
+        with self._db:
+            self._remove_file(path)
+            for t in transactions:
+                self._add_transaction(t)
+                self._db.execute('INSERT OR IGNORE INTO file_transactions (path, id) VALUES (?, ?)',
+                        (path, t['id']))
+            self._db.execute('INSERT INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                    (path, st.st_size, st.st_mtime))
+        return 1
+
+    def _remove_file(self, path):
+        keys = [key for (key,) in self._db.execute(
+                'SELECT id FROM file_transactions WHERE path = ?', (path,))]
+        self._db.execute('DELETE FROM file_transactions WHERE path = ?', (path,))
+        self._db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+        # Keep transactions that are still present in other files
+        for key in keys:
+            row = self._db.execute('SELECT 1 FROM file_transactions WHERE id = ? LIMIT 1',
+                    (key,)).fetchone()
+            if row is None:
+                self._remove_transaction(key)
+
+    def _terms(self, t):
+        return {
+                'account': [_normalize(t['account'])] if t['account'] else [],
+                'name': _words(t['name']),
+                'vs': [_normalize(t['vs'])] if t['vs'] else [],
+                'ks': [_normalize(t['ks'])] if t['ks'] else [],
+                'ss': [_normalize(t['ss'])] if t['ss'] else [],
+                'text': _words(t['name']) | _words(t['memo']),
+            }
+
+    def _add_transaction(self, t):
+        # Data from the latest file wins
+        self._remove_transaction(t['id'])
+
+        row = [t[column] for column in COLUMNS]
+        row[COLUMNS.index('amount')] = unicode(t['amount'])
+        self._db.execute('INSERT INTO transactions ({0}, magnitude) VALUES ({1}, ?)'.format(
+                ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                row + [float(abs(t['amount']))])
+        self._db.executemany('INSERT OR IGNORE INTO terms (field, term, id) VALUES (?, ?, ?)',
+                [(field, term, t['id'])
+                    for field, terms in self._terms(t).iteritems()
+                    for term in terms])
+
+    def _remove_transaction(self, key):
+        self._db.execute('DELETE FROM terms WHERE id = ?', (key,))
+        self._db.execute('DELETE FROM transactions WHERE id = ?', (key,))
+
+    def search(self, account=None, name=None, vs=None, ks=None, ss=None,
+            amount=None, min_amount=None, max_amount=None, text=None):
+        ''' Return transactions matching all the given criteria sorted by
+        date.
+        '''
+        queries = []
+        params = []
+        for field, value in (('account', account), ('vs', vs), ('ks', ks), ('ss', ss)):
+            if value is not None:
+                queries.append('SELECT id FROM terms WHERE field = ? AND term = ?')
+                params.extend([field, _normalize(value)])
+        for field, value in (('name', name), ('text', text)):
+            if value is not None:
+                for word in _words(value):
+                    queries.append('SELECT id FROM terms WHERE field = ? AND term = ?')
+                    params.extend([field, word])
+
+        # Amounts are looked up approximately and filtered exactly afterwards
+        if amount is not None:
+            min_amount = max_amount = abs(Decimal(amount))
+        conditions = []
+        if queries:
+            conditions.append('id IN ({0})'.format(' INTERSECT '.join(queries)))
+        if min_amount is not None:
+            min_amount = Decimal(min_amount)
+            conditions.append('magnitude >= ?')
+            params.append(float(min_amount))
+        if max_amount is not None:
+            max_amount = Decimal(max_amount)
+            conditions.append('magnitude <= ?')
+            params.append(float(max_amount))
+
+        sql = 'SELECT {0} FROM transactions'.format(', '.join(COLUMNS))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY date, id'
+
+        result = []
+        for row in self._db.execute(sql, params):
+            t = dict(zip(COLUMNS, row))
+            t['amount'] = Decimal(t['amount'])
+            if min_amount is not None and abs(t['amount']) < min_amount:
+                continue
+            if max_amount is not None and abs(t['amount']) > max_amount:
+                continue
+            result.append(t)
+        return result
+
+
+def _parse_args():
+    opts = docopt(__doc__)
+
+    args = {
+            'index_file': os.path.expanduser(opts['--index-file']),
+        }
+
+    if opts['add']:
+        args['cmd'] = 'add'
+        args['paths'] = opts['<path>']
+
+    elif opts['update']:
+        args['cmd'] = 'update'
+
+    elif opts['search']:
+        args['cmd'] = 'search'
+        args['query'] = {
+                'account': opts['--account'],
+                'name': opts['--name'],
+                'vs': opts['--vs'],
+                'ks': opts['--ks'],
+                'ss': opts['--ss'],
+                'amount': opts['--amount'],
+                'min_amount': opts['--min-amount'],
+                'max_amount': opts['--max-amount'],
+                'text': opts['--text'],
+            }
+        for key in ('name', 'text'):
+            if args['query'][key] is not None:
+                args['query'][key] = args['query'][key].decode('utf-8')
+
+    return args
+
+
+def main():
+    try:
+        # Parse arguments
+        args = _parse_args()
+
+        index = TransactionIndex(args['index_file'])
+
+        # Run the command
+        if args['cmd'] == 'add':
+            count = 0
+            for path in args['paths']:
+                count += index.add(path)
+            print 'Indexed {0} file(s)'.format(count)
+
+        elif args['cmd'] == 'update':
+            count = index.update()
+            print 'Indexed {0} file(s)'.format(count)
+
+        elif args['cmd'] == 'search':
+            for t in index.search(**args['query']):
+                line = u'\t'.join(unicode(t[key]) if t[key] is not None else u''
+                        for key in ('date', 'amount', 'currency', 'account', 'name', 'vs', 'ks', 'ss', 'memo'))
+                print line.encode('utf-8')
+
+        index.close()
+
+    except KeyboardInterrupt:
+        pass
+
+
+#  vim: expandtab sw=4
@@ -44,7 +44,8 @@ setup(name='ibank',
         entry_points={
                 'console_scripts': [
                     'ibank-citibankcz = ibank.citibankcz:main',
-                    'ibank-fio = ibank.fio:main'
+                    'ibank-fio = ibank.fio:main',
+                    'ibank-index = ibank.index:main'
                 ]
             }
     )
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from ibank.base import Bank, Transport, ValidatorCache, Format, formats, \
+        write_if_changed, RequestFailedError, UnsupportedFormatError
+from ibank.fio import Fio, FioError
+from ibank.citibankcz import CitibankCz
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content='', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.encoding = 'utf-8'
+        self.apparent_encoding = 'utf-8'
+
+
+class FakeSession(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.headers = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.headers.append(headers)
+        return self.responses.pop(0)
+
+
+class BankTest(unittest.TestCase):
+    def test_unsupported_format(self):
+        bank = Bank()
+        bank.transaction_formats = formats(Format('ofx'))
+        self.assertEqual(bank.transaction_format('ofx').name, 'ofx')
+        self.assertRaises(UnsupportedFormatError, bank.transaction_format, 'bogus')
+        self.assertRaises(UnsupportedFormatError, Fio().statement_format, 'bogus')
+
+    def test_check_content_type(self):
+        transport = Transport()
+        fmt = Format('ofx', content_types=['application/OFX'])
+        transport.check_content_type(FakeResponse(200, headers={'content-type': 'application/OFX; charset=utf-8'}), fmt)
+        transport.check_content_type(FakeResponse(200), Format('csv'))
+        self.assertRaises(RequestFailedError, transport.check_content_type,
+                FakeResponse(200, headers={'content-type': 'text/html'}), fmt)
+
+    def test_fio_body_types(self):
+        bank = Fio()
+        bank.transport._session = FakeSession([
+                FakeResponse(200, '%PDF-1.4', {'content-type': 'application/pdf'}),
+                FakeResponse(200, '<xml/>', {'content-type': 'text/xml'}),
+            ])
+        pdf = bank.get_statement('token', 2013, 1, 'pdf')
+        self.assertEqual(type(pdf), str)
+        self.assertEqual(pdf, '%PDF-1.4')
+        xml = bank.get_statement('token', 2013, 1, 'xml')
+        self.assertEqual(type(xml), unicode)
+
+    def test_fio_request_failed(self):
+        bank = Fio()
+        bank.transport._session = FakeSession([FakeResponse(500)])
+        self.assertRaises(FioError, bank.get_statement, 'token', 2013, 1, 'xml')
+
+    def test_citibank_format_codes(self):
+        codes = dict((name, fmt.code) for name, fmt in CitibankCz.transaction_formats.items())
+        self.assertEqual(codes, {
+                'ofx': 4,
+                'csv': 5,
+                'xls': 10,
+                'qif-quicken': 6,
+                'qif-ms': 7,
+            })
+
+
+class TransportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.transport = Transport(cache=ValidatorCache(os.path.join(self.tmpdir, 'cache')))
+        self.fmt = Format('ofx')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _download(self, cache_key):
+        return self.transport.download('GET', 'u', self.fmt, 'err', cache_key=cache_key)
+
+    def test_not_modified(self):
+        self.transport._session = FakeSession([
+                FakeResponse(200, 'A', {'etag': '"1"'}),
+                FakeResponse(304),
+            ])
+        self.assertEqual(self._download('k'), u'A')
+        self.assertEqual(self._download('k'), u'A')
+        self.assertEqual(self.transport._session.headers[1], {'if-none-match': '"1"'})
+        self.assertEqual(self.transport.stats['not_modified'], 1)
+
+    def test_not_modified_encoding(self):
+        first = FakeResponse(200, u'Platba Pražská'.encode('cp1250'), {'etag': '"1"'})
+        first.encoding = None
+        first.apparent_encoding = 'windows-1250'
+        self.transport._session = FakeSession([first, FakeResponse(304)])
+        self.assertEqual(self._download('k'), u'Platba Pražská')
+        self.assertEqual(self._download('k'), u'Platba Pražská')
+
+    def test_no_cache_key(self):
+        self.transport._session = FakeSession([
+                FakeResponse(200, 'A', {'etag': '"1"'}),
+                FakeResponse(200, 'B', {'etag': '"2"'}),
+            ])
+        self.assertEqual(self._download(None), u'A')
+        self.assertEqual(self._download(None), u'B')
+        self.assertEqual(self.transport._session.headers[1], {})
+        self.assertFalse(os.path.exists(self.transport.cache.path))
+
+    def test_no_validators(self):
+        self.transport._session = FakeSession([
+                FakeResponse(200, 'A'),
+                FakeResponse(200, 'A'),
+            ])
+        self._download('k')
+        self._download('k')
+        self.assertEqual(self.transport._session.headers[1], {})
+        self.assertFalse(os.path.exists(self.transport.cache.path))
+
+    def test_prune(self):
+        self.transport.cache.max_entries = 2
+        self.transport._session = FakeSession([
+                FakeResponse(200, 'A', {'etag': '"1"'}) for i in range(3)])
+        for i in range(3):
+            self._download(i)
+        self.assertEqual(len(os.listdir(self.transport.cache.path)), 4)
+
+    def test_write_if_changed(self):
+        path = os.path.join(self.tmpdir, 'out.ofx')
+        self.assertTrue(write_if_changed(path, 'A'))
+        self.assertFalse(write_if_changed(path, 'A'))
+
+        # The same document downloaded elsewhere must still replace a stale file
+        self.assertTrue(write_if_changed(path, 'B'))
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), 'B')
+
+
+#  vim: expandtab sw=4
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+from StringIO import StringIO
+
+from ibank.index import TransactionIndex, TransactionIndexError, \
+        parse_fio_json, parse_ofx, main
+
+
+FIO_JSON = u'''{"accountStatement": {
+    "info": {"accountId": "2400222222"},
+    "transactionList": {"transaction": [
+        {"column22": {"value": 1001}, "column0": {"value": "2013-01-05+0100"},
+         "column1": {"value": -1500.5}, "column14": {"value": "CZK"},
+         "column2": {"value": "000123456"}, "column3": {"value": "0800"},
+         "column10": {"value": "Pražská energetika"}, "column5": {"value": "0042"},
+         "column16": {"value": "Faktura leden"}},
+        {"column22": {"value": 1002}, "column0": {"value": "2013-01-07+0100"},
+         "column1": {"value": 250}, "column14": {"value": "CZK"},
+         "column10": {"value": "Jan Novák"}}
+    ]}
+}}'''
+
+OFX = u'''OFXHEADER:100
+<OFX>
+<BANKACCTFROM><ACCTID>999<CURDEF>CZK
+<BANKTRANLIST>
+<STMTTRN>
+<TRNTYPE>DEBIT
+<DTPOSTED>20130210
+<TRNAMT>-1000,00
+<FITID>X1
+<NAME>Prazska energetika
+<MEMO>unor
+<BANKACCTTO><BANKID>0800<ACCTID>123456</BANKACCTTO>
+<STMTTRN>
+<DTPOSTED>20130211
+<TRNAMT>99
+<NAME>Shop
+<STMTTRN>
+<DTPOSTED>20130211
+<TRNAMT>99
+<NAME>Shop
+<STMTTRN>
+<DTPOSTED>20130212
+<NAME>No amount
+</BANKTRANLIST>
+</OFX>
+'''
+
+
+class ParserTest(unittest.TestCase):
+    def test_fio_json(self):
+        transactions = list(parse_fio_json(FIO_JSON))
+        self.assertEqual(len(transactions), 2)
+        t = transactions[0]
+        self.assertEqual(t['id'], u'2400222222:1001')
+        self.assertEqual(t['date'], '2013-01-05')
+        self.assertEqual(t['amount'], Decimal('-1500.5'))
+        self.assertEqual(t['account'], u'000123456/0800')
+        self.assertEqual(t['vs'], u'0042')
+        self.assertEqual(t['memo'], u'Faktura leden')
+
+    def test_ofx(self):
+        transactions = list(parse_ofx(OFX))
+        self.assertEqual(len(transactions), 3)
+        t = transactions[0]
+        self.assertEqual(t['id'], u'999:X1')
+        self.assertEqual(t['date'], '2013-02-10')
+        self.assertEqual(t['amount'], Decimal('-1000.00'))
+        self.assertEqual(t['currency'], u'CZK')
+        self.assertEqual(t['account'], u'123456/0800')
+
+    def test_ofx_missing_fitid(self):
+        transactions = list(parse_ofx(OFX))
+        self.assertEqual(len(set(t['id'] for t in transactions)), 3)
+
+
+class TransactionIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = TransactionIndex()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, text, mtime=None):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fh:
+            fh.write(text.encode('utf-8'))
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def _ids(self, **query):
+        return [t['id'] for t in self.index.search(**query)]
+
+    def test_search(self):
+        self._write('fio.json', FIO_JSON)
+        self._write('citi.ofx', OFX)
+        self.assertEqual(self.index.add(self.tmpdir), 2)
+
+        self.assertEqual(self._ids(account='123456/0800'), [u'2400222222:1001', u'999:X1'])
+        self.assertEqual(self._ids(vs='42'), [u'2400222222:1001'])
+        self.assertEqual(self._ids(text=u'energetika leden'), [u'2400222222:1001'])
+        self.assertEqual(self._ids(name=u'novák'), [u'2400222222:1002'])
+
+    def test_amount(self):
+        self._write('fio.json', FIO_JSON)
+        self._write('citi.ofx', OFX)
+        self.index.add(self.tmpdir)
+
+        self.assertEqual(self._ids(amount='1500.5'), [u'2400222222:1001'])
+        self.assertEqual(self._ids(min_amount='90', max_amount='250'),
+                [u'2400222222:1002'] + sorted(self._ids(name=u'shop')))
+        self.assertEqual(self._ids(min_amount='1000', max_amount='1000'), [u'999:X1'])
+
+    def test_reindex(self):
+        path = self._write('fio.json', FIO_JSON, mtime=1000000000)
+        self.index.add(self.tmpdir)
+        self.assertEqual(self.index.update(), 0)
+
+        self._write('fio.json', FIO_JSON.replace(u'"0042"', u'"77"'), mtime=1000000100)
+        self.assertEqual(self.index.update(), 1)
+        self.assertEqual(self._ids(vs='42'), [])
+        self.assertEqual(self._ids(vs='77'), [u'2400222222:1001'])
+
+        os.remove(path)
+        self.index.update()
+        self.assertEqual(len(self.index), 0)
+
+    def test_overlapping_files(self):
+        self._write('a.json', FIO_JSON)
+        path = self._write('b.json', FIO_JSON)
+        self.index.add(self.tmpdir)
+        os.remove(path)
+        self.index.update()
+        self.assertEqual(len(self.index), 2)
+
+    def test_stray_file(self):
+        self._write('package.json', u'{"name": "foo"}')
+        self._write('fio.json', FIO_JSON)
+        self.assertEqual(self.index.add(self.tmpdir), 1)
+        self.assertEqual(len(self.index), 2)
+
+        stray = self._write('broken.ofx', u'<STMTTRN><TRNAMT>abc</BANKTRANLIST>')
+        self.assertRaises(TransactionIndexError, self.index.add, stray)
+
+    def test_broken_symlink(self):
+        self._write('fio.json', FIO_JSON)
+        os.symlink(os.path.join(self.tmpdir, 'missing.ofx'), os.path.join(self.tmpdir, 'old.ofx'))
+        self.assertEqual(self.index.add(self.tmpdir), 1)
+
+
+class MainTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datadir = os.path.join(self.tmpdir, 'data')
+        os.mkdir(self.datadir)
+        self.index_file = os.path.join(self.tmpdir, 'index.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _main(self, *argv):
+        old_argv, old_stdout = sys.argv, sys.stdout
+        sys.argv = ['ibank-index'] + list(argv) + ['--index-file', self.index_file]
+        sys.stdout = StringIO()
+        try:
+            main()
+            return sys.stdout.getvalue().splitlines()
+        finally:
+            sys.argv, sys.stdout = old_argv, old_stdout
+
+    def test_cli(self):
+        with open(os.path.join(self.datadir, 'fio.json'), 'w') as fh:
+            fh.write(FIO_JSON.encode('utf-8'))
+
+        self.assertEqual(self._main('add', self.datadir), ['Indexed 1 file(s)'])
+        self.assertEqual(self._main('update'), ['Indexed 0 file(s)'])
+
+        lines = self._main('search', '--vs', '42')
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0].split('\t')[:4], ['2013-01-05', '-1500.5', 'CZK', '000123456/0800'])
+        self.assertEqual(self._main('search', '--min-amount', '2000'), [])
+
+
+#  vim: expandtab sw=4